@@ -1,16 +1,27 @@
 import os
 import re
-import json
+import functools
+import asyncio
+import time
 import logging
-from typing import Dict, List, Optional, Any
-from datetime import datetime
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Any, Set, Tuple
+import orjson
 from dotenv import load_dotenv
 import vertexai
 from vertexai.generative_models import GenerativeModel
 from google.oauth2 import service_account
-from fetch_mails import search_messages, parse_email
-from gmail_auth import gmail_authenticate
-from tenacity import retry, stop_after_attempt, wait_exponential
+from fetch_mails import BATCH_SIZE, search_messages, fetch_messages, parse_message
+from gmail_auth import gmail_authenticate, refresh_if_expiring, service_account_info
+from file_utils import atomic_write
+from llm_cache import LLMCache
+from batcher import TransactionBatcher
+from deterministic_parser import (
+    INFO_RE, apply_email_date, deterministic_parse, lookup_category_hint, normalize_amount
+)
+from google.api_core.exceptions import DeadlineExceeded, ResourceExhausted, ServiceUnavailable
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
 
 # Set up logging
 logging.basicConfig(
@@ -21,31 +32,150 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 
+# Messages below LOG_LEVEL are dropped by the logger itself, so call sites
+# log unconditionally instead of checking a verbosity flag
+logging.getLogger().setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+
 PROJECT_ID = os.getenv('PROJECT_ID')
 LOCATION = os.getenv('LOCATION')
+# Regional endpoints bypass Provisioned Throughput; leave unset to let the SDK
+# derive the endpoint from LOCATION, or use aiplatform.googleapis.com with
+# LOCATION=global to route requests through purchased throughput.
+VERTEX_API_ENDPOINT = os.getenv('VERTEX_API_ENDPOINT') or None
 SERVICE_ACCOUNT_FILE = 'ASTservice.json'
+# Number of transactions formatted by a single model request
+TRANSACTIONS_PER_PROMPT = int(os.getenv('TRANSACTIONS_PER_PROMPT', '15'))
+# A flash model is fast enough for this narrowly constrained formatting task
+MODEL_NAME = os.getenv('MODEL_NAME', 'gemini-1.5-flash-002')
+LLM_CACHE_FILE = os.getenv('LLM_CACHE_FILE', 'llm_cache.json')
+# Sheet rows waiting for sheets_integration to upload them
+TRANSACTION_DATA_FILE = 'transaction_data.json'
+# When set, only emails received since the last run that handled every
+# email are fetched
+LAST_RUN_FILE = os.getenv('LAST_RUN_FILE')
+# When set, only emails from the last SEARCH_DAYS_BACK days are fetched
+SEARCH_DAYS_BACK = int(os.getenv('SEARCH_DAYS_BACK')) if os.getenv('SEARCH_DAYS_BACK') else None
+# When set, emails already turned into sheet rows are never fetched again
+PROCESSED_IDS_FILE = os.getenv('PROCESSED_IDS_FILE')
+
+# Maximum number of Vertex AI requests in flight at once
+MAX_CONCURRENT_REQUESTS = 10
+# How long a transaction waits for others to share its request, and the
+# request latency above which the batch size is reduced
+BATCH_MAX_WAIT_MS = int(os.getenv('BATCH_MAX_WAIT_MS', '200'))
+BATCH_LATENCY_SLO = float(os.getenv('BATCH_LATENCY_SLO', '20'))
+
+# Backfills of at least this many transactions go through a batch prediction
+# job instead of online requests when a Cloud Storage location is configured
+BATCH_JOB_GCS_URI = os.getenv('BATCH_JOB_GCS_URI')
+BATCH_JOB_THRESHOLD = int(os.getenv('BATCH_JOB_THRESHOLD', '100'))
+
+# A formatted transaction is a single JSON object well under 200 tokens;
+# batch prompts get this budget once per transaction
+MAX_OUTPUT_TOKENS = int(os.getenv('MAX_OUTPUT_TOKENS', '256'))
+# Most output tokens the model returns per request (8192 for Gemini flash)
+MODEL_OUTPUT_TOKEN_LIMIT = int(os.getenv('MODEL_OUTPUT_TOKEN_LIMIT', '8192'))
+
+# Larger batches can't give every transaction its output budget, and would
+# be rejected by the model if asked to
+MAX_TRANSACTIONS_PER_PROMPT = max(1, MODEL_OUTPUT_TOKEN_LIMIT // MAX_OUTPUT_TOKENS)
+if TRANSACTIONS_PER_PROMPT > MAX_TRANSACTIONS_PER_PROMPT:
+    logger.warning(
+        "TRANSACTIONS_PER_PROMPT=%s exceeds the model's output limit, using %s",
+        TRANSACTIONS_PER_PROMPT, MAX_TRANSACTIONS_PER_PROMPT
+    )
+    TRANSACTIONS_PER_PROMPT = MAX_TRANSACTIONS_PER_PROMPT
 
-ALLOWED_CATEGORIES = [
+GENERATION_CONFIG = {
+    "temperature": 0.1,
+    "max_output_tokens": min(MAX_OUTPUT_TOKENS, MODEL_OUTPUT_TOKEN_LIMIT),
+    "top_p": 1.0,
+    "top_k": 40,
+    # Constrain decoding to JSON so responses need no markdown cleanup
+    "response_mime_type": "application/json"
+}
+
+ALLOWED_CATEGORIES = frozenset([
     "Transport", "Food & Dining", "Travel", "Home", 
     "Utilities", "People", "Shopping", "Grocery", "Other"
-]
-
-# Category hints for better classification
-CATEGORY_HINTS = {
-    "OpenRouter": "Utilities",  # Web service
-    "Namecheap": "Utilities",   # Domain/hosting service
-    "Old Peter": "Food & Dining",  # Restaurant
-    "Balam": "Food & Dining",   # Restaurant
-    "City Market": "Grocery",   # Supermarket
-    "Deckers": "Shopping",      # Retail
-    "Mood Up": "Shopping",      # Retail
-    "Cosmet": "Shopping",       # Cosmetics/Retail
-    "Casa De Los Cirios": "Food & Dining"  # Restaurant
-}
+])
+
+# Field checks for model output, compiled once
+REQUIRED_FIELDS = ('amount', 'currency', 'merchant', 'category', 'date', 'time', 'account')
+AMOUNT_RE = re.compile(r'^\d+\.\d{2}$')
+DATE_RE = re.compile(r'^(0[1-9]|[12]\d|3[01])-(0[1-9]|1[0-2])-\d{4}$')
+TIME_RE = re.compile(r'^(0?[1-9]|1[0-2]):[0-5][0-9] [AP]M$')
+
+# Bump whenever PROMPT_PREAMBLE or the prompt builders change, so cached
+# responses produced by the old prompt are no longer used
+PROMPT_VERSION = "v2"
+
+# Static instructions shared by every request. Sent as the system
+# instruction so that each prompt only carries the transaction itself.
+PROMPT_PREAMBLE = (
+    "Format each transaction as a JSON object. Important rules:\n\n"
+    "1. Output MUST be raw JSON only - no markdown, no code blocks, no backticks, no extra text. "
+    "Return a single object for one transaction, or an array with one object per transaction "
+    "for a numbered list of transactions; each object in the array also has an \"index\" field "
+    "holding the transaction's number\n"
+    "2. Field requirements:\n"
+    "   - amount: string with exactly 2 decimal places (e.g., \"10.95\", \"466.40\")\n"
+    "   - currency: uppercase string (e.g., \"USD\", \"EUR\", \"MXN\")\n"
+    "   - merchant: full business name including location if provided\n"
+    "   - category: must be exactly one of the allowed categories\n"
+    "   - date: string in DD-MM-YYYY format\n"
+    "   - time: string in HH:MM AM/PM format\n"
+    "   - account: string (e.g., \"Wise\", \"PayPal\")\n\n"
+    "3. Allowed categories and their rules:\n"
+    "   - Transport: rides, fuel, parking, vehicle services\n"
+    "   - Food & Dining: restaurants, cafes, bars, food delivery\n"
+    "   - Travel: hotels, flights, tourism activities\n"
+    "   - Home: furniture, maintenance, home services\n"
+    "   - Utilities: internet, phone, web services, hosting, domains, subscriptions\n"
+    "   - People: transfers, gifts, personal services\n"
+    "   - Shopping: retail stores, online shopping, general merchandise\n"
+    "   - Grocery: supermarkets, food stores, markets\n"
+    "   - Other: anything that doesn't fit above categories\n\n"
+    "4. Specific merchant categorization:\n"
+    "   - Web services (like OpenRouter, Namecheap) -> Utilities\n"
+    "   - Restaurants (like Old Peter, Balam) -> Food & Dining\n"
+    "   - Retail stores (like Deckers) -> Shopping\n"
+    "   - Supermarkets (like City Market) -> Grocery"
+)
+
+@functools.lru_cache(maxsize=1)
+def vertex_credentials() -> service_account.Credentials:
+    return service_account.Credentials.from_service_account_info(
+        service_account_info(SERVICE_ACCOUNT_FILE),
+        scopes=['https://www.googleapis.com/auth/cloud-platform']
+    )
+
+@functools.lru_cache(maxsize=4)
+def init_vertex(project_id: str, location: str, api_endpoint: Optional[str] = None) -> None:
+    """
+    Initializes the Vertex AI SDK once per project/location/endpoint.
+    
+    Args:
+        project_id: Google Cloud project ID
+        location: Vertex AI location
+        api_endpoint: Optional API endpoint overriding the regional default
+    """
+    credentials = vertex_credentials()
+    # Fetch the access token up front rather than on the first model call
+    refresh_if_expiring(credentials)
+    vertexai.init(
+        project=project_id,
+        location=location,
+        credentials=credentials,
+        api_endpoint=api_endpoint
+    )
 
 def create_prompt(transaction_info: Dict[str, Any]) -> str:
     """
-    Creates a prompt for the AI model to format transaction data.
+    Creates the per-transaction part of the prompt.
+    
+    The formatting rules live in PROMPT_PREAMBLE, which is passed to the
+    model as its system instruction.
     
     Args:
         transaction_info: Dictionary containing transaction details
@@ -53,57 +183,65 @@ def create_prompt(transaction_info: Dict[str, Any]) -> str:
     Returns:
         Formatted prompt string
     """
-    prompt_text = (
-        "Format this transaction as a single JSON object. Important rules:\n\n"
-        "1. Output MUST be a raw JSON object only - no markdown, no code blocks, no backticks, no extra text\n"
-        "2. Field requirements:\n"
-        "   - amount: string with exactly 2 decimal places (e.g., \"10.95\", \"466.40\")\n"
-        "   - currency: uppercase string (e.g., \"USD\", \"EUR\", \"MXN\")\n"
-        "   - merchant: full business name including location if provided\n"
-        "   - category: must be exactly one of the allowed categories\n"
-        "   - date: string in DD-MM-YYYY format\n"
-        "   - time: string in HH:MM AM/PM format\n"
-        "   - account: string (e.g., \"Wise\", \"PayPal\")\n\n"
-        "3. Allowed categories and their rules:\n"
-        "   - Transport: rides, fuel, parking, vehicle services\n"
-        "   - Food & Dining: restaurants, cafes, bars, food delivery\n"
-        "   - Travel: hotels, flights, tourism activities\n"
-        "   - Home: furniture, maintenance, home services\n"
-        "   - Utilities: internet, phone, web services, hosting, domains, subscriptions\n"
-        "   - People: transfers, gifts, personal services\n"
-        "   - Shopping: retail stores, online shopping, general merchandise\n"
-        "   - Grocery: supermarkets, food stores, markets\n"
-        "   - Other: anything that doesn't fit above categories\n\n"
-        "4. Specific merchant categorization:\n"
-        "   - Web services (like OpenRouter, Namecheap) -> Utilities\n"
-        "   - Restaurants (like Old Peter, Balam) -> Food & Dining\n"
-        "   - Retail stores (like Deckers) -> Shopping\n"
-        "   - Supermarkets (like City Market) -> Grocery\n\n"
-        f"Transaction to format: {transaction_info}"
-    )
-    return prompt_text
+    return f"Transaction to format: {transaction_info}"
 
-def clean_json_response(response: str) -> str:
+def create_batch_prompt(transaction_infos: List[Dict[str, Any]]) -> str:
     """
-    Cleans the model's response to extract only the JSON object.
+    Creates the prompt for formatting several transactions in one request.
     
     Args:
-        response: Raw response from the model
+        transaction_infos: List of transaction details
+        
+    Returns:
+        Formatted prompt string asking for a JSON array of numbered objects
+    """
+    lines = [
+        f"Transactions to format ({len(transaction_infos)}), "
+        f"return a JSON array with exactly {len(transaction_infos)} objects, "
+        f"each with the transaction's number as \"index\":"
+    ]
+    for number, transaction_info in enumerate(transaction_infos, start=1):
+        lines.append(f"{number}. {transaction_info}")
+    return "\n".join(lines)
+
+def init_model(model_name: str) -> GenerativeModel:
+    """
+    Initializes the Gemini model with the prompt preamble as system instruction.
+    
+    The preamble is far below the minimum size of a Vertex AI context cache,
+    so it is sent as a regular system instruction with every request.
+    
+    Args:
+        model_name: Versioned Gemini model name
         
     Returns:
-        Cleaned JSON string
+        Initialized model
+    """
+    return GenerativeModel(model_name, system_instruction=PROMPT_PREAMBLE)
+
+def parse_json_response(response: str, open_char: str = '{', close_char: str = '}') -> Any:
     """
-    # Remove any markdown code fences and language identifiers
-    cleaned = re.sub(r'```(?:json)?\s*', '', response)
-    cleaned = cleaned.strip('`').strip()
+    Extracts and parses the JSON value from the model's response.
     
-    # Find the JSON object boundaries
-    start = cleaned.find('{')
-    end = cleaned.rfind('}') + 1
+    Slicing from the first opening to the last closing character drops any
+    markdown code fences or surrounding text without a regex pass.
     
-    if start != -1 and end != -1:
-        return cleaned[start:end]
-    return cleaned
+    Args:
+        response: Raw response from the model
+        open_char: Opening character of the expected JSON value ('[' for arrays)
+        close_char: Closing character of the expected JSON value (']' for arrays)
+        
+    Returns:
+        Parsed JSON value
+        
+    Raises:
+        orjson.JSONDecodeError: If no valid JSON value is found
+    """
+    start = response.find(open_char)
+    end = response.rfind(close_char)
+    if start != -1 and end > start:
+        response = response[start:end + 1]
+    return orjson.loads(response)
 
 def validate_transaction_data(data: Dict[str, str]) -> bool:
     """
@@ -115,157 +253,695 @@ def validate_transaction_data(data: Dict[str, str]) -> bool:
     Returns:
         True if valid, False otherwise
     """
-    required_fields = ['amount', 'currency', 'merchant', 'category', 'date', 'time', 'account']
-    
-    try:
-        # Check all required fields exist
-        if not all(field in data for field in required_fields):
-            logger.error(f"Missing required fields. Got: {list(data.keys())}")
-            return False
-            
-        # Validate amount format (number with 2 decimal places)
-        amount = float(data['amount'])
-        if not re.match(r'^\d+\.\d{2}$', data['amount']):
-            logger.error(f"Invalid amount format: {data['amount']}")
-            return False
-            
-        # Validate category
-        if data['category'] not in ALLOWED_CATEGORIES:
-            logger.error(f"Invalid category: {data['category']}")
-            return False
-            
-        # Validate date format
-        datetime.strptime(data['date'], '%d-%m-%Y')
+    # Check all required fields exist
+    if not all(field in data for field in REQUIRED_FIELDS):
+        logger.error("Missing required fields. Got: %s", list(data.keys()))
+        return False
         
-        # Validate time format
-        if not re.match(r'^(0?[1-9]|1[0-2]):[0-5][0-9] [AP]M$', data['time']):
-            logger.error(f"Invalid time format: {data['time']}")
-            return False
-            
-        return True
-    except (ValueError, TypeError) as e:
-        logger.error(f"Validation error: {str(e)}")
+    # Every field is written to the sheet as text
+    if not all(isinstance(data[field], str) for field in REQUIRED_FIELDS):
+        logger.error("Non-string fields in: %s", data)
         return False
+        
+    # Validate amount format (number with 2 decimal places)
+    if not AMOUNT_RE.match(data['amount']):
+        logger.error("Invalid amount format: %s", data['amount'])
+        return False
+        
+    # Validate category
+    if data['category'] not in ALLOWED_CATEGORIES:
+        logger.error("Invalid category: %s", data['category'])
+        return False
+        
+    # Validate date format
+    if not DATE_RE.match(data['date']):
+        logger.error("Invalid date format: %s", data['date'])
+        return False
+        
+    # Validate time format
+    if not TIME_RE.match(data['time']):
+        logger.error("Invalid time format: %s", data['time'])
+        return False
+        
+    return True
+
+# Whether the traffic type of a model response has been logged yet
+_traffic_type_logged = False
+
+def extract_response_text(response: Any) -> Optional[str]:
+    """
+    Extracts the text of the first candidate from a model response.
+    
+    The parts are read directly because response.text raises on blocked or
+    empty candidates, which would only trigger useless retries.
+    
+    Args:
+        response: Response returned by generate_content
+        
+    Returns:
+        Model's response text or None if there is none
+    """
+    global _traffic_type_logged
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is not None:
+        logger.debug(
+            "Prompt tokens: %s, output tokens: %s",
+            getattr(usage, 'prompt_token_count', None),
+            getattr(usage, 'candidates_token_count', None)
+        )
+    if not _traffic_type_logged:
+        traffic_type = getattr(usage, 'traffic_type', None)
+        if traffic_type is not None:
+            logger.info("Model traffic type: %s", getattr(traffic_type, 'name', traffic_type))
+            _traffic_type_logged = True
+
+    if not response.candidates:
+        logger.warning("Model returned no candidates")
+        return None
+    parts = response.candidates[0].content.parts
+    text = ''.join(getattr(part, 'text', None) or '' for part in parts)
+    return text or None
 
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
-def prompt_vertex(model: GenerativeModel, prompt_text: str) -> Optional[str]:
+# Only transient Vertex AI errors are retried; bad requests and auth errors
+# fail fast. Jitter keeps concurrent requests from retrying in lockstep.
+model_retry = retry(
+    retry=retry_if_exception_type((ResourceExhausted, ServiceUnavailable, DeadlineExceeded)),
+    stop=stop_after_attempt(3),
+    wait=wait_random_exponential(multiplier=1, min=4, max=10)
+)
+
+@model_retry
+async def prompt_vertex_async(
+    model: GenerativeModel,
+    prompt_text: str,
+    generation_config: Optional[Dict[str, Any]] = None
+) -> Optional[str]:
     """
-    Sends a prompt to the Vertex AI model with retry logic.
+    Sends a prompt to the Vertex AI model without blocking the event loop.
     
     Args:
         model: Initialized Vertex AI model
         prompt_text: The prompt to send
+        generation_config: Generation parameters, GENERATION_CONFIG by default
         
     Returns:
         Model's response text or None if failed
     """
     try:
         logger.info("Sending prompt to model")
-        response = model.generate_content(
-            prompt_text,
-            generation_config={
-                "temperature": 0.1,
-                "max_output_tokens": 8192,
-                "top_p": 1.0,
-                "top_k": 40
-            }
+        response = await model.generate_content_async(
+            prompt_text, generation_config=generation_config or GENERATION_CONFIG
         )
         logger.info("Received response from model")
-        return response.text if response.text else None
+        return extract_response_text(response)
     except Exception as e:
-        logger.error(f"Error getting model response: {str(e)}")
+        logger.error("Error getting model response (%s): %s", type(e).__name__, e)
         raise
 
-def process_transaction(model: GenerativeModel, transaction_info: Dict[str, Any]) -> Optional[List[str]]:
+def to_sheet_row(transaction_data: Dict[str, Any]) -> List[str]:
     """
-    Processes a single transaction through the AI model.
+    Converts validated transaction data into a spreadsheet row.
+    
+    Args:
+        transaction_data: Dictionary containing transaction data
+        
+    Returns:
+        List of transaction data fields in sheet column order
+    """
+    return [
+        transaction_data.get('date', ''),
+        transaction_data.get('time', ''),
+        transaction_data.get('merchant', ''),
+        transaction_data.get('amount', ''),
+        transaction_data.get('currency', ''),
+        transaction_data.get('category', ''),
+        transaction_data.get('account', ''),
+    ]
+
+def format_without_model(
+    transaction_info: Dict[str, Any],
+    cache: Optional[LLMCache] = None,
+    stats: Optional[Counter] = None
+) -> Optional[List[str]]:
+    """
+    Formats a transaction from known merchant rules or a cached response.
     
     Args:
-        model: Initialized Vertex AI model
         transaction_info: Transaction details to process
+        cache: Optional response cache
+        stats: Optional counter incremented under 'rules' or 'cache' on a hit
         
     Returns:
-        List of transaction data fields or None if processing failed
+        List of transaction data fields or None if the model is needed
     """
-    if not transaction_info.get('info'):
-        logger.info("No transaction info found")
+    # Known merchants don't need the model at all
+    decoded = deterministic_parse(transaction_info)
+    if decoded is not None and validate_transaction_data(decoded):
+        logger.info("Formatted transaction without the model")
+        if stats is not None:
+            stats['rules'] += 1
+        return to_sheet_row(decoded)
+
+    if cache is not None:
+        cached = cache.get(cache.make_key(transaction_info))
+        # A cached entry still holds the date of the email it came from, so
+        # it is only usable when this email's own date can replace it
+        if cached is not None and apply_email_date(cached, transaction_info.get('date')):
+            if validate_transaction_data(cached):
+                logger.info("Using cached model response")
+                if stats is not None:
+                    stats['cache'] += 1
+                return to_sheet_row(cached)
+    return None
+
+def matches_source(transaction_data: Dict[str, Any], transaction_info: Dict[str, Any]) -> bool:
+    """
+    Checks the model's amount and currency against the email's transaction line.
+    
+    Args:
+        transaction_data: Validated transaction data returned by the model
+        transaction_info: Transaction details the data was generated from
+        
+    Returns:
+        False if the data belongs to a different transaction, True otherwise
+    """
+    match = INFO_RE.match(transaction_info.get('info') or '')
+    if not match:
+        return True
+    raw_amount, currency, _ = match.groups()
+    if transaction_data['currency'] != currency:
+        return False
+    # Amounts with an ambiguous format can only be checked by the currency
+    amount = normalize_amount(raw_amount)
+    return amount is None or transaction_data['amount'] == amount
+
+def finalize_transaction(
+    transaction_data: Dict[str, Any],
+    transaction_info: Dict[str, Any],
+    cache: Optional[LLMCache] = None
+) -> Optional[List[str]]:
+    """
+    Applies category hints to model output, validates and caches it.
+    
+    Output whose amount or currency differs from the email is rejected, so
+    a response mixed up with another transaction never reaches the cache.
+    
+    Args:
+        transaction_data: Transaction data returned by the model
+        transaction_info: Transaction details the data was generated from
+        cache: Optional response cache to store valid results in
+        
+    Returns:
+        List of transaction data fields or None if validation failed
+    """
+    if not isinstance(transaction_data, dict):
+        logger.error("Expected a JSON object, got: %s", transaction_data)
         return None
+
+    # Apply category hints if available; a merchant of any other type is
+    # rejected by validation below
+    merchant = transaction_data.get('merchant')
+    category = lookup_category_hint(merchant) if isinstance(merchant, str) else None
+    if category:
+        transaction_data['category'] = category
+    
+    if not validate_transaction_data(transaction_data):
+        logger.error("Transaction data validation failed")
+        return None
+
+    if not matches_source(transaction_data, transaction_info):
+        logger.error(
+            "Model output %s %s doesn't match transaction: %s",
+            transaction_data['amount'], transaction_data['currency'], transaction_info['info']
+        )
+        return None
+
+    if cache is not None:
+        cache.set(cache.make_key(transaction_info), transaction_data)
         
-    prompt = create_prompt(transaction_info)
-    model_response = prompt_vertex(model, prompt)
+    return to_sheet_row(transaction_data)
+
+def handle_transaction_response(
+    model_response: Optional[str],
+    transaction_info: Dict[str, Any],
+    cache: Optional[LLMCache] = None
+) -> Optional[List[str]]:
+    """
+    Turns the model's response for a single transaction into a sheet row.
     
+    Args:
+        model_response: Model's response text
+        transaction_info: Transaction details the response was generated from
+        cache: Optional response cache to store valid results in
+        
+    Returns:
+        List of transaction data fields or None if the response is unusable
+    """
     if not model_response:
         logger.error("Failed to get model response")
         return None
         
     try:
-        cleaned_response = clean_json_response(model_response)
-        transaction_data = json.loads(cleaned_response)
-        
-        # Apply category hints if available
-        merchant = transaction_data.get('merchant', '')
-        for key, category in CATEGORY_HINTS.items():
-            if key.lower() in merchant.lower():
-                transaction_data['category'] = category
-                break
+        transaction_data = parse_json_response(model_response)
+        return finalize_transaction(transaction_data, transaction_info, cache)
+    except orjson.JSONDecodeError as e:
+        logger.error("JSON decode error: %s", e)
+        logger.debug("Raw response: %s", model_response)
+        return None
+
+async def process_transaction_async(
+    model: GenerativeModel,
+    transaction_info: Dict[str, Any],
+    cache: Optional[LLMCache] = None
+) -> Optional[List[str]]:
+    """
+    Processes a single transaction through the AI model asynchronously.
+    
+    Args:
+        model: Initialized Vertex AI model
+        transaction_info: Transaction details to process
+        cache: Optional response cache consulted before calling the model
         
-        if not validate_transaction_data(transaction_data):
-            logger.error("Transaction data validation failed")
-            return None
-            
-        return [
-            transaction_data.get('date', ''),
-            transaction_data.get('time', ''),
-            transaction_data.get('merchant', ''),
-            transaction_data.get('amount', ''),
-            transaction_data.get('currency', ''),
-            transaction_data.get('category', ''),
-            transaction_data.get('account', ''),
-        ]
-    except json.JSONDecodeError as e:
-        logger.error(f"JSON decode error: {str(e)}")
-        logger.debug(f"Raw response: {model_response}")
-        logger.debug(f"Cleaned response: {cleaned_response}")
+    Returns:
+        List of transaction data fields or None if processing failed
+    """
+    if not transaction_info.get('info'):
+        logger.info("No transaction info found")
         return None
 
-if __name__ == '__main__':
+    row = format_without_model(transaction_info, cache)
+    if row is not None:
+        return row
+
+    model_response = await prompt_vertex_async(model, create_prompt(transaction_info))
+    return handle_transaction_response(model_response, transaction_info, cache)
+
+async def process_transaction_batch(
+    model: GenerativeModel,
+    transaction_infos: List[Dict[str, Any]],
+    cache: Optional[LLMCache] = None
+) -> List[Optional[List[str]]]:
+    """
+    Processes several transactions with a single AI model request.
+    
+    Array elements are matched to transactions by their index field. If
+    the response isn't an array, transactions without exactly one element
+    carrying their index are sent in a request of their own.
+    
+    Args:
+        model: Initialized Vertex AI model
+        transaction_infos: Transaction details to process, all with info
+        cache: Optional response cache to store valid results in
+        
+    Returns:
+        List of results in input order, None for failed transactions
+    """
+    if len(transaction_infos) == 1:
+        return [await process_transaction_async(model, transaction_infos[0], cache)]
+
+    prompt = create_batch_prompt(transaction_infos)
+    started = time.perf_counter()
+    generation_config = dict(
+        GENERATION_CONFIG,
+        max_output_tokens=min(MODEL_OUTPUT_TOKEN_LIMIT, MAX_OUTPUT_TOKENS * len(transaction_infos))
+    )
+    model_response = await prompt_vertex_async(model, prompt, generation_config)
+    elapsed = time.perf_counter() - started
+    logger.info(
+        "Batch of %s transactions took %.2fs (%.2fs per transaction)",
+        len(transaction_infos), elapsed, elapsed / len(transaction_infos)
+    )
+
+    transactions = None
+    if model_response:
+        try:
+            transactions = parse_json_response(model_response, '[', ']')
+        except orjson.JSONDecodeError as e:
+            logger.error("JSON decode error: %s", e)
+            logger.debug("Raw response: %s", model_response)
+
+    if not isinstance(transactions, list):
+        logger.warning("Batch response unusable, processing transactions one by one")
+        transactions = []
+
+    by_number: Dict[int, Any] = {}
+    duplicates = set()
+    for transaction_data in transactions:
+        number = transaction_data.pop('index', None) if isinstance(transaction_data, dict) else None
+        if type(number) is not int or not 1 <= number <= len(transaction_infos):
+            logger.warning("Ignoring batch element without a valid index: %s", transaction_data)
+        elif number in by_number:
+            duplicates.add(number)
+        else:
+            by_number[number] = transaction_data
+
+    results = []
+    for number, transaction_info in enumerate(transaction_infos, start=1):
+        if number in by_number and number not in duplicates:
+            results.append(finalize_transaction(by_number[number], transaction_info, cache))
+        else:
+            if transactions:
+                logger.warning("No unique batch element for transaction %s, retrying it alone", number)
+            results.append(await process_transaction_async(model, transaction_info, cache))
+    return results
+
+async def process_transactions(
+    batcher: TransactionBatcher,
+    transaction_infos: List[Dict[str, Any]],
+    cache: Optional[LLMCache] = None
+) -> List[Optional[List[str]]]:
+    """
+    Processes transactions concurrently through the AI model.
+    
+    Transactions that can be formatted from rules or the cache are resolved
+    first; the rest are submitted to the run's TransactionBatcher, which
+    coalesces them into requests of up to TRANSACTIONS_PER_PROMPT
+    transactions.
+    
+    Args:
+        batcher: Running batcher shared by every chunk of the run
+        transaction_infos: List of transaction details to process
+        cache: Optional response cache consulted before calling the model
+        
+    Returns:
+        List of results in input order, None for failed transactions
+    """
+    results: List[Optional[List[str]]] = [None] * len(transaction_infos)
+    pending = []
+    stats: Counter = Counter()
+    for index, transaction_info in enumerate(transaction_infos):
+        if not transaction_info.get('info'):
+            logger.info("No transaction info found")
+            continue
+        row = format_without_model(transaction_info, cache, stats)
+        if row is not None:
+            results[index] = row
+        else:
+            pending.append(index)
+    logger.info(
+        "Formatted %s transactions from merchant rules, %s from cache, "
+        "sending %s to the model",
+        stats['rules'], stats['cache'], len(pending)
+    )
+
+    rows = await asyncio.gather(
+        *(batcher.submit(transaction_infos[index]) for index in pending)
+    )
+    for index, row in zip(pending, rows):
+        results[index] = row
+    return results
+
+def parse_fetched(
+    msg_ids: List[str],
+    fetched: Dict[str, Dict[str, Any]]
+) -> Tuple[List[str], List[Dict[str, Any]]]:
+    """
+    Parses fetched messages in the order of their IDs.
+    
+    Args:
+        msg_ids: Requested message IDs
+        fetched: Messages returned by fetch_messages, keyed by ID
+        
+    Returns:
+        Tuple of the IDs that were fetched and their transaction details
+    """
+    parsed_ids = []
+    transaction_infos = []
+    for msg_id in msg_ids:
+        if msg_id not in fetched:
+            continue
+        transaction_info = parse_message(fetched[msg_id])
+        logger.info("Processing transaction: %s", transaction_info)
+        parsed_ids.append(msg_id)
+        transaction_infos.append(transaction_info)
+    return parsed_ids, transaction_infos
+
+async def fetch_and_process_messages(
+    service,
+    model: GenerativeModel,
+    msg_ids: List[str],
+    cache: Optional[LLMCache] = None
+) -> Tuple[List[str], List[Dict[str, Any]], List[Optional[List[str]]]]:
+    """
+    Fetches messages in Gmail batches and formats each batch while the next
+    one is being fetched.
+    
+    Every batch goes through one TransactionBatcher, so its tuned batch size
+    carries over from one Gmail batch to the next and the tail of one can
+    share a model request with the start of the next.
+    
+    Args:
+        service: Gmail API service instance
+        model: Initialized Vertex AI model
+        msg_ids: IDs of the messages to process
+        cache: Optional response cache consulted before calling the model
+        
+    Returns:
+        Tuple of the fetched message IDs, their transaction details and
+        their results, None for failed transactions
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def produce() -> None:
+        try:
+            for start in range(0, len(msg_ids), BATCH_SIZE):
+                chunk = msg_ids[start:start + BATCH_SIZE]
+                fetched = await asyncio.to_thread(fetch_messages, service, chunk)
+                await queue.put(parse_fetched(chunk, fetched))
+        finally:
+            await queue.put(None)
+
+    batcher = TransactionBatcher(
+        lambda infos: process_transaction_batch(model, infos, cache),
+        max_batch=TRANSACTIONS_PER_PROMPT,
+        max_concurrent=MAX_CONCURRENT_REQUESTS,
+        max_wait=BATCH_MAX_WAIT_MS / 1000,
+        latency_slo=BATCH_LATENCY_SLO
+    )
+    parsed_ids: List[str] = []
+    transaction_infos: List[Dict[str, Any]] = []
+    chunk_tasks = []
+    async with batcher:
+        producer = asyncio.create_task(produce())
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            chunk_ids, chunk_infos = item
+            parsed_ids.extend(chunk_ids)
+            transaction_infos.extend(chunk_infos)
+            # Not awaited here, so the next batch is submitted as soon as it
+            # has been fetched
+            chunk_tasks.append(asyncio.create_task(
+                process_transactions(batcher, chunk_infos, cache)
+            ))
+        chunk_results = await asyncio.gather(*chunk_tasks)
+    # Surfaces any error raised while fetching
+    await producer
+    results = [row for rows in chunk_results for row in rows]
+    return parsed_ids, transaction_infos, results
+
+def load_last_run(path: Optional[str]) -> Tuple[Optional[int], Set[str]]:
+    """
+    Reads the start time of the last run that handled every email.
+    
+    Args:
+        path: State file path, or None if incremental runs are disabled
+        
+    Returns:
+        Tuple of the Unix timestamp, None if there is no such run, and the
+        IDs of emails already handled by later, incomplete runs
+    """
+    if not path or not os.path.exists(path):
+        return None, set()
     try:
-        # Load credentials from the service account file
-        credentials = service_account.Credentials.from_service_account_file(
-            SERVICE_ACCOUNT_FILE,
-            scopes=['https://www.googleapis.com/auth/cloud-platform']
+        with open(path, 'rb') as f:
+            state = orjson.loads(f.read())
+        started_at = state.get('startedAt')
+        return (
+            int(started_at) if started_at is not None else None,
+            set(state.get('handledIds', []))
         )
+    except (OSError, ValueError, AttributeError, TypeError) as e:
+        logger.warning("Ignoring unreadable last run file %s: %s", path, e)
+        return None, set()
+
+def load_processed_ids(path: Optional[str]) -> Set[str]:
+    """
+    Reads the IDs of emails handled by previous runs.
+    
+    Args:
+        path: Checkpoint file path, or None if the checkpoint is disabled
         
-        # Initialize Vertex AI with credentials
-        vertexai.init(project=PROJECT_ID, location=LOCATION, credentials=credentials)
+    Returns:
+        Set of Gmail message IDs
+    """
+    if not path or not os.path.exists(path):
+        return set()
+    try:
+        with open(path, 'rb') as f:
+            return set(orjson.loads(f.read()))
+    except (OSError, ValueError, TypeError) as e:
+        logger.warning("Ignoring unreadable processed IDs file %s: %s", path, e)
+        return set()
+
+def load_pending_rows(path: str) -> List[List[str]]:
+    """
+    Reads sheet rows saved by earlier runs that haven't been uploaded yet.
+    
+    Args:
+        path: Transaction data file path
         
-        # Initialize the Gemini model
-        model = GenerativeModel("gemini-1.5-flash-002")
+    Returns:
+        List of sheet rows, empty if there are none
+    """
+    if not os.path.exists(path):
+        return []
+    try:
+        with open(path, 'rb') as f:
+            rows = orjson.loads(f.read())
+        return rows if isinstance(rows, list) else []
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring unreadable transaction data file %s: %s", path, e)
+        return []
+
+def process_transactions_batch_job(
+    transaction_infos: List[Dict[str, Any]],
+    cache: Optional[LLMCache] = None
+) -> List[Optional[List[str]]]:
+    """
+    Processes transactions with a Vertex AI batch prediction job.
+    
+    Args:
+        transaction_infos: Transaction details to process
+        cache: Optional response cache consulted before submitting the job
         
-        # Initialize Gmail service
-        service = gmail_authenticate()
+    Returns:
+        List of results in input order, None for failed transactions
+    """
+    results: List[Optional[List[str]]] = [None] * len(transaction_infos)
+    pending = []
+    for index, transaction_info in enumerate(transaction_infos):
+        if not transaction_info.get('info'):
+            continue
+        row = format_without_model(transaction_info, cache)
+        if row is not None:
+            results[index] = row
+        else:
+            pending.append(index)
+
+    if not pending:
+        return results
+
+    # Imported here since Cloud Storage and batch prediction are only needed
+    # for backfills
+    from batch_job import run_batch_job
+    responses = run_batch_job(
+        MODEL_NAME,
+        [create_prompt(transaction_infos[i]) for i in pending],
+        PROMPT_PREAMBLE,
+        GENERATION_CONFIG,
+        BATCH_JOB_GCS_URI,
+        project=PROJECT_ID,
+        credentials=vertex_credentials()
+    )
+    for index, model_response in zip(pending, responses):
+        results[index] = handle_transaction_response(
+            model_response, transaction_infos[index], cache
+        )
+    return results
+
+if __name__ == '__main__':
+    try:
+        # Gmail auth and the response cache don't depend on Vertex AI, so
+        # they are set up in the background while the model is initialized
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            service_future = executor.submit(gmail_authenticate)
+            cache_future = executor.submit(LLMCache, LLM_CACHE_FILE, PROMPT_VERSION, MODEL_NAME)
+            
+            # Initialize Vertex AI with credentials
+            init_vertex(PROJECT_ID, LOCATION, VERTEX_API_ENDPOINT)
+            
+            # Initialize the Gemini model
+            model = init_model(MODEL_NAME)
+            
+            service = service_future.result()
+            cache = cache_future.result()
         
         sheet_data = []
-        messages = search_messages(service)
+        started_at = int(time.time())
+        last_run, handled_ids = load_last_run(LAST_RUN_FILE)
+        messages = search_messages(service, after=last_run, days_back=SEARCH_DAYS_BACK)
+        processed_ids = load_processed_ids(PROCESSED_IDS_FILE)
+        newly_processed = []
+        # The last run time only moves forward once every email the search
+        # returned was fetched and handled, so failed ones are searched again
+        run_complete = messages is not None
         
         if messages:
-            for msg in messages:
-                transaction_info = parse_email(service, 'me', msg['id'])
-                logger.info(f"Processing transaction: {transaction_info}")
-                
-                result = process_transaction(model, transaction_info)
-                if result:
-                    sheet_data.append(result)
+            msg_ids = [
+                msg['id'] for msg in messages
+                if msg['id'] not in processed_ids and msg['id'] not in handled_ids
+            ]
+            logger.info("Skipping %s already processed emails", len(messages) - len(msg_ids))
+            
+            if BATCH_JOB_GCS_URI and len(msg_ids) >= BATCH_JOB_THRESHOLD:
+                parsed_ids, transaction_infos = parse_fetched(
+                    msg_ids, fetch_messages(service, msg_ids)
+                )
+                results = process_transactions_batch_job(transaction_infos, cache)
+            else:
+                parsed_ids, transaction_infos, results = asyncio.run(
+                    fetch_and_process_messages(service, model, msg_ids, cache)
+                )
+            sheet_data = [result for result in results if result]
+            cache.save()
+            # Emails without a transaction are skipped too; emails that
+            # failed to fetch or format are retried by the next run
+            newly_processed = [
+                msg_id
+                for msg_id, transaction_info, result in zip(parsed_ids, transaction_infos, results)
+                if result or not transaction_info.get('info')
+            ]
+            run_complete = len(newly_processed) == len(msg_ids)
         else:
             logger.info("No messages found")
         
         # Save the transaction data
         if sheet_data:
-            with open('transaction_data.json', 'w') as f:
-                json.dump(sheet_data, f, indent=2)
-            logger.info(f"Saved {len(sheet_data)} transactions to transaction_data.json")
+            if LAST_RUN_FILE or PROCESSED_IDS_FILE:
+                # Emails behind rows that haven't been uploaded yet won't be
+                # fetched again, so those rows are kept
+                pending_rows = load_pending_rows(TRANSACTION_DATA_FILE)
+                if pending_rows:
+                    logger.info("Keeping %s rows not uploaded yet", len(pending_rows))
+                sheet_data = pending_rows + sheet_data
+            atomic_write(
+                TRANSACTION_DATA_FILE,
+                orjson.dumps(sheet_data, option=orjson.OPT_INDENT_2)
+            )
+            logger.info("Saved %s transactions to %s", len(sheet_data), TRANSACTION_DATA_FILE)
         else:
             logger.warning("No transactions were processed successfully")
+
+        if LAST_RUN_FILE:
+            if run_complete:
+                atomic_write(LAST_RUN_FILE, orjson.dumps({'startedAt': started_at}))
+            else:
+                logger.warning("Some emails failed, the next run searches from the previous run again")
+                if newly_processed:
+                    # The same window is searched again, so the emails that
+                    # succeeded are recorded to keep their rows from being
+                    # produced twice
+                    handled_ids.update(newly_processed)
+                    atomic_write(LAST_RUN_FILE, orjson.dumps({
+                        'startedAt': last_run,
+                        'handledIds': sorted(handled_ids)
+                    }))
+
+        if PROCESSED_IDS_FILE and newly_processed:
+            processed_ids.update(newly_processed)
+            atomic_write(PROCESSED_IDS_FILE, orjson.dumps(sorted(processed_ids)))
             
     except Exception as e:
-        logger.error(f"Error during execution: {str(e)}", exc_info=True)
+        logger.error("Error during execution: %s", e, exc_info=True)
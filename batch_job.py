@@ -0,0 +1,152 @@
+import time
+import uuid
+import logging
+from typing import Dict, List, Optional, Any, Tuple
+import orjson
+from google.cloud import storage
+from vertexai.batch_prediction import BatchPredictionJob
+
+logger = logging.getLogger(__name__)
+
+# Seconds between job state checks
+POLL_INTERVAL = 30
+
+def split_gcs_uri(uri: str) -> Tuple[str, str]:
+    """
+    Splits a gs://bucket/prefix URI into its bucket and prefix.
+
+    Args:
+        uri: Cloud Storage URI
+
+    Returns:
+        Tuple of bucket name and prefix without surrounding slashes
+    """
+    if not uri.startswith('gs://'):
+        raise ValueError(f"Not a Cloud Storage URI: {uri}")
+    bucket, _, prefix = uri[len('gs://'):].partition('/')
+    return bucket, prefix.strip('/')
+
+def build_request_line(
+    prompt: str,
+    system_instruction: str,
+    generation_config: Dict[str, Any]
+) -> bytes:
+    """
+    Serializes a prompt as one line of a batch prediction input file.
+
+    Args:
+        prompt: The prompt to send
+        system_instruction: Static instructions shared by every request
+        generation_config: Generation parameters for the request
+
+    Returns:
+        JSON line terminated by a newline
+    """
+    request = {
+        'request': {
+            'contents': [{'role': 'user', 'parts': [{'text': prompt}]}],
+            'systemInstruction': {'parts': [{'text': system_instruction}]},
+            'generationConfig': generation_config,
+        }
+    }
+    return orjson.dumps(request) + b'\n'
+
+def read_predictions(
+    storage_client: storage.Client,
+    output_location: str
+) -> Dict[str, Optional[str]]:
+    """
+    Reads the response text of every prediction written by a batch job.
+
+    Args:
+        storage_client: Cloud Storage client
+        output_location: gs:// directory the job wrote its results to
+
+    Returns:
+        Dictionary mapping prompt text to response text, None for failed rows
+    """
+    bucket_name, prefix = split_gcs_uri(output_location)
+    predictions = {}
+    for blob in storage_client.list_blobs(bucket_name, prefix=prefix):
+        if not blob.name.endswith('.jsonl'):
+            continue
+        for line in blob.download_as_bytes().splitlines():
+            if not line.strip():
+                continue
+            row = orjson.loads(line)
+            try:
+                prompt = row['request']['contents'][0]['parts'][0]['text']
+            except (KeyError, IndexError, TypeError):
+                logger.warning("Skipping prediction without a recognizable request")
+                continue
+            text = None
+            candidates = (row.get('response') or {}).get('candidates') or []
+            if candidates:
+                parts = (candidates[0].get('content') or {}).get('parts') or []
+                text = ''.join(part.get('text') or '' for part in parts) or None
+            if text is None:
+                logger.warning("Prediction failed: %s", row.get('status') or 'no candidates')
+            predictions[prompt] = text
+    return predictions
+
+def run_batch_job(
+    model_name: str,
+    prompts: List[str],
+    system_instruction: str,
+    generation_config: Dict[str, Any],
+    gcs_uri: str,
+    project: Optional[str] = None,
+    credentials: Optional[Any] = None,
+    poll_interval: int = POLL_INTERVAL
+) -> List[Optional[str]]:
+    """
+    Formats prompts with the Vertex AI Batch Prediction API.
+
+    Meant for backfills where waiting for the job is acceptable: the prompts
+    are uploaded as a JSONL file, the job is polled until it ends and the
+    responses are read back from Cloud Storage.
+
+    Args:
+        model_name: Vertex AI model to run the job with
+        prompts: Prompts to send
+        system_instruction: Static instructions shared by every prompt
+        generation_config: Generation parameters for every prompt
+        gcs_uri: gs:// prefix the input and output files are written under
+        project: Google Cloud project ID
+        credentials: Credentials for Cloud Storage
+        poll_interval: Seconds between job state checks
+
+    Returns:
+        List of response texts in prompt order, None for failed prompts
+    """
+    storage_client = storage.Client(project=project, credentials=credentials)
+    bucket_name, prefix = split_gcs_uri(gcs_uri)
+    run_prefix = '/'.join(filter(None, [prefix, f"batch-{uuid.uuid4().hex}"]))
+
+    input_blob = storage_client.bucket(bucket_name).blob(f"{run_prefix}/input.jsonl")
+    input_blob.upload_from_string(
+        b''.join(
+            build_request_line(prompt, system_instruction, generation_config)
+            for prompt in dict.fromkeys(prompts)
+        ),
+        content_type='application/jsonl'
+    )
+
+    job = BatchPredictionJob.submit(
+        source_model=model_name,
+        input_dataset=f"gs://{bucket_name}/{input_blob.name}",
+        output_uri_prefix=f"gs://{bucket_name}/{run_prefix}/output"
+    )
+    logger.info("Submitted batch prediction job %s for %s prompts", job.resource_name, len(prompts))
+
+    started = time.perf_counter()
+    while not job.has_ended:
+        time.sleep(poll_interval)
+        job.refresh()
+    logger.info("Batch prediction job ended after %.0fs", time.perf_counter() - started)
+
+    if not job.has_succeeded:
+        raise RuntimeError(f"Batch prediction job failed: {job.error}")
+
+    predictions = read_predictions(storage_client, job.output_location)
+    return [predictions.get(prompt) for prompt in prompts]
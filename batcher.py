@@ -0,0 +1,124 @@
+import time
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Longest time a request waits for others to share its model call
+MAX_WAIT = 0.2
+# Batch latency above which the batch size is halved
+LATENCY_SLO = 20.0
+
+class TransactionBatcher:
+    """
+    Coalesces transactions submitted close together into batched model calls.
+
+    A dispatcher task takes up to batch_size queued transactions, or whatever
+    arrived within max_wait of the first one, and hands them to process_batch.
+    The batch size adapts to the latency of whole batches: it is halved when
+    a batch fails or exceeds the latency SLO, and doubled after a full batch
+    fast enough that twice its size should still meet the SLO. Larger
+    batches spread the fixed cost of a request over more transactions, so
+    the size grows back to max_batch once the model keeps up again.
+
+    Use as an async context manager and await submit() for each transaction.
+    """
+
+    def __init__(
+        self,
+        process_batch: Callable[[List[Any]], Awaitable[List[Any]]],
+        max_batch: int,
+        max_concurrent: int,
+        max_wait: float = MAX_WAIT,
+        latency_slo: float = LATENCY_SLO
+    ):
+        self.process_batch = process_batch
+        self.max_batch = max(1, max_batch)
+        self.batch_size = self.max_batch
+        self.max_wait = max_wait
+        self.latency_slo = latency_slo
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._queue: Optional[asyncio.Queue] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._in_flight: Set[asyncio.Task] = set()
+
+    async def __aenter__(self) -> 'TransactionBatcher':
+        self._queue = asyncio.Queue()
+        self._dispatcher = asyncio.create_task(self._dispatch())
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        self._dispatcher.cancel()
+        await asyncio.gather(self._dispatcher, *self._in_flight, return_exceptions=True)
+
+    async def submit(self, item: Any) -> Any:
+        """
+        Queues a transaction and waits for its result.
+
+        Args:
+            item: Transaction to process
+
+        Returns:
+            The transaction's result, None if its batch failed
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((item, future))
+        return await future
+
+    async def _dispatch(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            # A free slot is taken first, so the batch is cut at the size
+            # set by the batches that finished before it
+            await self._semaphore.acquire()
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            task = asyncio.create_task(self._run(batch, self.batch_size))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _run(self, batch: List[Tuple[Any, asyncio.Future]], size: int) -> None:
+        started = time.perf_counter()
+        try:
+            results = await self.process_batch([item for item, _ in batch])
+        except Exception as e:
+            logger.error("Error processing transactions: %s", e)
+            results = [None] * len(batch)
+            self._adjust(None, len(batch), size)
+        else:
+            self._adjust(time.perf_counter() - started, len(batch), size)
+        finally:
+            self._semaphore.release()
+
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    def _adjust(self, latency: Optional[float], count: int, size: int) -> None:
+        # latency is the duration of the whole batch, or None if it failed;
+        # size is the batch size in effect when the batch was cut
+        previous = self.batch_size
+        if latency is None or latency > self.latency_slo:
+            # Batches cut before an earlier reduction don't reduce it again
+            self.batch_size = min(self.batch_size, max(1, size // 2))
+        elif count >= size == self.batch_size and 2 * latency <= self.latency_slo:
+            # A partial batch says nothing about whether a larger one would
+            # meet the SLO, so only full ones grow the batch size
+            self.batch_size = min(self.max_batch, size * 2)
+        if self.batch_size != previous:
+            logger.info("Batch size adjusted from %s to %s", previous, self.batch_size)
@@ -0,0 +1,130 @@
+import re
+import logging
+from typing import Dict, Optional, Any
+
+logger = logging.getLogger(__name__)
+
+# Category hints for better classification
+CATEGORY_HINTS = {
+    "OpenRouter": "Utilities",  # Web service
+    "Namecheap": "Utilities",   # Domain/hosting service
+    "Old Peter": "Food & Dining",  # Restaurant
+    "Balam": "Food & Dining",   # Restaurant
+    "City Market": "Grocery",   # Supermarket
+    "Deckers": "Shopping",      # Retail
+    "Mood Up": "Shopping",      # Retail
+    "Cosmet": "Shopping",       # Cosmetics/Retail
+    "Casa De Los Cirios": "Food & Dining"  # Restaurant
+}
+
+# Single-pass, case-insensitive lookup of CATEGORY_HINTS; the name of the
+# matching group identifies the category
+HINT_CATEGORIES = {f'h{i}': category for i, category in enumerate(CATEGORY_HINTS.values())}
+HINT_RE = re.compile(
+    '|'.join(f'(?P<h{i}>{re.escape(key)})' for i, key in enumerate(CATEGORY_HINTS)),
+    re.IGNORECASE
+)
+
+# Transaction line produced by fetch_mails.parse_message for every supported
+# email template: "You spent <amount> <currency> at <merchant>."
+INFO_RE = re.compile(r'^You spent ([\d,\.]+) ([A-Z]{3}) at (.+?)\.?$')
+
+# Email date as produced by parse_message; split with a regex instead of going
+# through strptime/strftime for every rule or cache hit
+EMAIL_DATE_RE = re.compile(r'^(\d{2}-\d{2}-\d{4}) ([01]\d|2[0-3]):([0-5]\d) [AP]M$')
+
+# Amount formats that can be normalized without the model
+US_AMOUNT_RE = re.compile(r'^\d+(?:,\d{3})*(?:\.\d{1,2})?$')     # 1,234.50
+EU_AMOUNT_RE = re.compile(r'^\d+(?:\.\d{3})*,\d{1,2}$')          # 1.234,50
+
+def apply_email_date(transaction_data: Dict[str, Any], email_date: Optional[str]) -> bool:
+    """
+    Overwrites date and time of a cached transaction with the email's own.
+    
+    Args:
+        transaction_data: Dictionary containing transaction data, updated in place
+        email_date: Date string as produced by parse_message ('%d-%m-%Y %H:%M %p')
+        
+    Returns:
+        True if date and time were set, False if the email has no usable date
+    """
+    if not email_date:
+        return False
+    match = EMAIL_DATE_RE.match(email_date)
+    if not match:
+        logger.warning("Could not parse email date: %s", email_date)
+        return False
+    date, hour, minute = match.groups()
+    # The hour is 24-hour despite the AM/PM suffix, as with strptime's %H
+    hour = int(hour)
+    transaction_data['date'] = date
+    transaction_data['time'] = f"{hour % 12 or 12:02d}:{minute} {'AM' if hour < 12 else 'PM'}"
+    return True
+
+def lookup_category_hint(merchant: str) -> Optional[str]:
+    """
+    Looks up the category for a known merchant.
+    
+    Args:
+        merchant: Merchant name
+        
+    Returns:
+        Category from CATEGORY_HINTS or None if the merchant is unknown
+    """
+    match = HINT_RE.search(merchant)
+    if match:
+        return HINT_CATEGORIES[match.lastgroup]
+    return None
+
+def normalize_amount(amount: str) -> Optional[str]:
+    """
+    Normalizes an amount to a string with exactly 2 decimal places.
+    
+    Args:
+        amount: Amount as it appears in the email (e.g. "1,234.5" or "12,50")
+        
+    Returns:
+        Normalized amount or None if the format is ambiguous
+    """
+    if US_AMOUNT_RE.match(amount):
+        value = amount.replace(',', '')
+    elif EU_AMOUNT_RE.match(amount):
+        value = amount.replace('.', '').replace(',', '.')
+    else:
+        return None
+    return f"{float(value):.2f}"
+
+def deterministic_parse(transaction_info: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Builds transaction data directly from the parsed email for known merchants.
+    
+    Only merchants covered by CATEGORY_HINTS and unambiguous amounts are
+    handled; anything else is left to the model.
+    
+    Args:
+        transaction_info: Transaction details to process
+        
+    Returns:
+        Transaction data or None if the model is needed
+    """
+    match = INFO_RE.match(transaction_info['info'])
+    if not match or not transaction_info.get('date') or not transaction_info.get('account'):
+        return None
+
+    raw_amount, currency, merchant = match.groups()
+    merchant = merchant.strip()
+    category = lookup_category_hint(merchant)
+    amount = normalize_amount(raw_amount)
+    if category is None or amount is None:
+        return None
+
+    transaction_data = {
+        'amount': amount,
+        'currency': currency,
+        'merchant': merchant,
+        'category': category,
+        'account': transaction_info['account'],
+    }
+    if not apply_email_date(transaction_data, transaction_info['date']):
+        return None
+    return transaction_data
@@ -1,10 +1,11 @@
 import base64
+import html
 import re
+import time
+import random
 import logging
-from datetime import datetime
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Tuple
 import email.utils
-from bs4 import BeautifulSoup
 from gmail_auth import gmail_authenticate
 
 # Set up logging
@@ -14,50 +15,150 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def search_messages(service, user_id: str = 'me') -> Optional[List[Dict[str, Any]]]:
+# Gmail accepts up to 100 calls per batch request, but calls in a batch are
+# rate limited individually and large batches often get some of them rejected
+BATCH_SIZE = 50
+# Attempts for messages whose call failed with a transient error
+FETCH_ATTEMPTS = 3
+# Statuses of failed calls that are worth retrying
+RETRYABLE_STATUSES = frozenset([429, 500, 502, 503, 504])
+# Largest page of search results Gmail returns (the default is 100)
+SEARCH_PAGE_SIZE = 500
+
+# Transaction patterns for supported email templates (Wise, then PayPal),
+# combined so the text is scanned only once
+TRANSACTION_RE = re.compile(
+    r'You spent (?P<w_amount>[\d,\.]+) (?P<w_currency>[A-Z]{3}) at (?P<w_merchant>[^.]+)'
+    r'|Sie haben (?P<p_amount>[\d,\.]+) (?P<p_currency>[A-Z]{3}) (?:an |to )(?P<p_merchant>[^.]+) gesendet'
+)
+
+# A merchant matched in raw HTML that still contains markup, entities or
+# unnormalized whitespace needs the text conversion first
+MARKUP_RE = re.compile(r'[<>&\r\n\t]|\s\s')
+
+# Cheap HTML-to-text conversion used before falling back to a DOM
+HIDDEN_ELEMENT_RE = re.compile(r'<(title|style|script)\b.*?</\1\s*>', re.IGNORECASE | re.DOTALL)
+TAG_RE = re.compile(r'<[^>]+>')
+WHITESPACE_RE = re.compile(r'\s+')
+
+def search_messages(
+    service,
+    user_id: str = 'me',
+    after: Optional[int] = None,
+    days_back: Optional[int] = None
+) -> Optional[List[Dict[str, Any]]]:
     """
     Search for transaction emails from Wise and PayPal.
     
+    Follows nextPageToken until every page of results has been read.
+    
     Args:
         service: Gmail API service instance
         user_id: User's email address. Default 'me' refers to authenticated user
+        after: Optional Unix timestamp; only emails received after it are returned
+        days_back: Optional number of days; only emails newer than that are returned
         
     Returns:
-        List of message objects or None if error occurs
+        List of message objects or None if error occurs, including an error
+        on a later page
     """
     query = (
         '(from:noreply@wise.com ("You spent" OR "is now in")) OR '
         '(from:service@paypal.de "Von Ihnen gezahlt")'
     )
+    if after is not None:
+        # Let Gmail skip emails handled by a previous run
+        query = f'({query}) after:{after}'
+    if days_back is not None:
+        query = f'({query}) newer_than:{days_back}d'
     try:
         logger.info("Searching for transaction emails")
-        response = service.users().messages().list(userId=user_id, q=query).execute()
-        messages = response.get('messages', [])
-        logger.info(f"Found {len(messages)} transaction emails")
+        messages = []
+        page_token = None
+        while True:
+            response = service.users().messages().list(
+                userId=user_id, q=query, maxResults=SEARCH_PAGE_SIZE, pageToken=page_token
+            ).execute()
+            messages.extend(response.get('messages', []))
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                break
+        logger.info("Found %s transaction emails", len(messages))
         return messages
     except Exception as error:
-        logger.error(f'Error searching messages: {error}')
+        logger.error('Error searching messages: %s', error)
         return None
 
-def get_email_body(service, user_id: str, msg_id: str) -> Optional[str]:
+def fetch_messages(service, msg_ids: List[str], user_id: str = 'me') -> Dict[str, Dict[str, Any]]:
     """
-    Get the HTML body of an email message.
+    Fetch full Gmail messages using batch requests.
+    
+    Calls rejected with a rate limit or server error are retried with
+    backoff, up to FETCH_ATTEMPTS times in total.
     
     Args:
         service: Gmail API service instance
-        user_id: User's email address
-        msg_id: Message ID
+        msg_ids: List of message IDs to fetch
+        user_id: User's email address. Default 'me' refers to authenticated user
         
     Returns:
-        HTML content of the email or None if error occurs
+        Dictionary mapping message ID to the full message resource
     """
-    try:
-        message = service.users().messages().get(
-            userId=user_id, 
-            id=msg_id, 
-            format='full'
-        ).execute()
+    messages: Dict[str, Dict[str, Any]] = {}
+    retryable: List[str] = []
 
+    def store_message(request_id, response, exception):
+        if exception is None:
+            messages[request_id] = response
+            return
+        status = getattr(getattr(exception, 'resp', None), 'status', None)
+        if status is None or int(status) in RETRYABLE_STATUSES:
+            retryable.append(request_id)
+        else:
+            logger.error('Error fetching message %s: %s', request_id, exception)
+
+    pending = list(msg_ids)
+    for attempt in range(FETCH_ATTEMPTS):
+        if attempt:
+            # Back off with jitter before retrying the rejected calls
+            delay = 2 ** attempt + random.random()
+            logger.warning("Retrying %s messages in %.1fs", len(pending), delay)
+            time.sleep(delay)
+        retryable.clear()
+        start = 0
+        try:
+            for start in range(0, len(pending), BATCH_SIZE):
+                batch = service.new_batch_http_request(callback=store_message)
+                for msg_id in pending[start:start + BATCH_SIZE]:
+                    batch.add(
+                        service.users().messages().get(userId=user_id, id=msg_id, format='full'),
+                        request_id=msg_id
+                    )
+                batch.execute()
+        except Exception as error:
+            logger.error('Error fetching messages: %s', error)
+            # The batch request itself failed; retry everything it didn't return
+            retryable.extend(msg_id for msg_id in pending[start:] if msg_id not in messages)
+        pending = list(dict.fromkeys(retryable))
+        if not pending:
+            break
+
+    if pending:
+        logger.error("Giving up on %s messages after %s attempts", len(pending), FETCH_ATTEMPTS)
+    logger.info("Fetched %s of %s messages", len(messages), len(msg_ids))
+    return messages
+
+def get_email_body(message: Dict[str, Any]) -> Optional[str]:
+    """
+    Get the HTML body of a full Gmail message.
+    
+    Args:
+        message: Message resource fetched with format='full'
+        
+    Returns:
+        HTML content of the email or None if not found
+    """
+    try:
         parts = [message['payload']]
         while parts:
             part = parts.pop()
@@ -68,17 +169,72 @@ def get_email_body(service, user_id: str, msg_id: str) -> Optional[str]:
                 return base64.urlsafe_b64decode(data).decode('utf-8')
         return None
     except Exception as error:
-        logger.error(f'Error getting email body: {error}')
+        logger.error('Error getting email body: %s', error)
         return None
 
-def parse_email(service, user_id: str, msg_id: str) -> Dict[str, Optional[str]]:
+def strip_tags(html_content: str) -> str:
     """
-    Parse transaction details from an email.
+    Convert HTML to plain text with regexes, without building a DOM.
     
     Args:
-        service: Gmail API service instance
-        user_id: User's email address
-        msg_id: Message ID
+        html_content: HTML content of the email
+        
+    Returns:
+        Whitespace-normalized text content
+    """
+    text = HIDDEN_ELEMENT_RE.sub(' ', html_content)
+    text = html.unescape(TAG_RE.sub(' ', text))
+    return WHITESPACE_RE.sub(' ', text).strip()
+
+def dom_text(html_content: str) -> str:
+    """
+    Convert HTML to plain text with lxml's C parser.
+    
+    Args:
+        html_content: HTML content of the email
+        
+    Returns:
+        Visible text content of the email, one space between text nodes
+    """
+    # Imported here since most emails are handled by the regex fast paths
+    import lxml.html
+    from lxml import etree
+
+    try:
+        # Parsed as UTF-8 bytes since lxml rejects str input that carries an
+        # XML encoding declaration; the body was decoded as UTF-8 already
+        tree = lxml.html.document_fromstring(
+            html_content.encode('utf-8'), parser=lxml.html.HTMLParser(encoding='utf-8')
+        )
+    except etree.ParserError:
+        return ''
+    # Drop elements whose text is never shown to the reader
+    etree.strip_elements(tree, 'title', 'style', 'script', etree.Comment, with_tail=False)
+    return ' '.join(text.strip() for text in tree.itertext() if text.strip())
+
+def find_transaction(text: str) -> Optional[Tuple[str, str, str]]:
+    """
+    Match the supported transaction templates against text.
+    
+    Args:
+        text: Email text, or raw HTML
+        
+    Returns:
+        Tuple of amount, currency and merchant, or None if nothing matched
+    """
+    match = TRANSACTION_RE.search(text)
+    if not match:
+        return None
+    if match.group('w_amount'):
+        return match.group('w_amount', 'w_currency', 'w_merchant')
+    return match.group('p_amount', 'p_currency', 'p_merchant')
+
+def parse_message(message: Dict[str, Any]) -> Dict[str, Optional[str]]:
+    """
+    Parse transaction details from a full Gmail message.
+    
+    Args:
+        message: Message resource fetched with format='full'
         
     Returns:
         Dictionary containing transaction details
@@ -89,87 +245,102 @@ def parse_email(service, user_id: str, msg_id: str) -> Dict[str, Optional[str]]:
         'account': None
     }
 
-    html_content = get_email_body(service, user_id, msg_id)
+    html_content = get_email_body(message)
     if not html_content:
         logger.error("Failed to get email body")
         return transaction_details
 
-    # Parse HTML content
-    soup = BeautifulSoup(html_content, 'html.parser')
-    if soup.title:
-        soup.title.decompose()
-    text_content = soup.get_text(separator=" ", strip=True)
-    
     try:
-        # Get message metadata
-        message = service.users().messages().get(
-            userId=user_id, 
-            id=msg_id, 
-            format='metadata'
-        ).execute()
-        headers = message['payload']['headers']
+        # Headers come back with the full message, no extra request needed
+        headers = {h['name']: h['value'] for h in message['payload']['headers']}
         
         # Determine account type from sender
-        from_header = next((h for h in headers if h['name'] == 'From'), None)
+        from_header = headers.get('From')
         if from_header:
-            if 'wise.com' in from_header['value']:
+            if 'wise.com' in from_header:
                 transaction_details['account'] = 'Wise'
-            elif 'paypal.de' in from_header['value']:
+            elif 'paypal.de' in from_header:
                 transaction_details['account'] = 'PayPal'
                 
         # Parse date
-        date_header = next((h for h in headers if h['name'] == 'Date'), None)
+        date_header = headers.get('Date')
         if date_header:
-            date_tuple = email.utils.parsedate_tz(date_header['value'])
-            if date_tuple:
-                transaction_details['date'] = datetime.fromtimestamp(
-                    email.utils.mktime_tz(date_tuple)
-                ).strftime('%d-%m-%Y %H:%M %p')
-
-        # Parse transaction details
-        wise_pattern = re.compile(r'You spent ([\d,\.]+) ([A-Z]{3}) at ([^.]+)')
-        paypal_pattern = re.compile(
-            r'Sie haben ([\d,\.]+) ([A-Z]{3}) (?:an |to )([^.]+) gesendet'
-        )
+            try:
+                # Converted to local time, like the timestamps shown in Gmail
+                sent_at = email.utils.parsedate_to_datetime(date_header).astimezone()
+                transaction_details['date'] = sent_at.strftime('%d-%m-%Y %H:%M %p')
+            except (TypeError, ValueError):
+                logger.warning("Could not parse Date header: %s", date_header)
 
-        wise_match = wise_pattern.search(text_content)
-        paypal_match = paypal_pattern.search(text_content)
+        # Parse transaction details from the raw HTML when the template text
+        # isn't split by markup, then with the cheap tag stripper, and only
+        # build a DOM when the known templates still don't match
+        transaction = find_transaction(html_content)
+        if transaction and MARKUP_RE.search(transaction[2]):
+            transaction = None
+        if not transaction:
+            transaction = find_transaction(strip_tags(html_content))
+        if not transaction:
+            transaction = find_transaction(dom_text(html_content))
 
-        if wise_match:
-            amount, currency, merchant = wise_match.groups()
-            transaction_details['info'] = (
-                f"You spent {amount} {currency} at {merchant}."
-            )
-        elif paypal_match:
-            amount, currency, merchant = paypal_match.groups()
-            # Convert German PayPal format to standard format
+        if transaction:
+            amount, currency, merchant = transaction
+            # PayPal's German template is converted to the standard format too
             transaction_details['info'] = (
                 f"You spent {amount} {currency} at {merchant}."
             )
         
         if transaction_details['info']:
-            logger.info(f"Successfully parsed transaction: {transaction_details}")
+            logger.info("Successfully parsed transaction: %s", transaction_details)
         else:
             logger.warning("No transaction details found in email")
             
     except Exception as e:
-        logger.error(f"Error parsing email: {e}")
+        logger.error("Error parsing email: %s", e)
 
     return transaction_details
 
+def parse_email(service, user_id: str, msg_id: str) -> Dict[str, Optional[str]]:
+    """
+    Fetch a single email and parse its transaction details.
+    
+    Args:
+        service: Gmail API service instance
+        user_id: User's email address
+        msg_id: Message ID
+        
+    Returns:
+        Dictionary containing transaction details
+    """
+    # A single format='full' request returns both the headers and the body
+    try:
+        message = service.users().messages().get(
+            userId=user_id, 
+            id=msg_id, 
+            format='full'
+        ).execute()
+    except Exception as error:
+        logger.error('Error fetching email: %s', error)
+        return {'date': None, 'info': None, 'account': None}
+    return parse_message(message)
+
 if __name__ == '__main__':
     try:
         service = gmail_authenticate()
         messages = search_messages(service)
         
         if messages:
-            for msg in messages:
-                transaction_info = parse_email(service, 'me', msg['id'])
+            msg_ids = [msg['id'] for msg in messages]
+            fetched = fetch_messages(service, msg_ids)
+            for msg_id in msg_ids:
+                if msg_id not in fetched:
+                    continue
+                transaction_info = parse_message(fetched[msg_id])
                 if transaction_info['info']:
-                    logger.info(f"Transaction found: {transaction_info}")
+                    logger.info("Transaction found: %s", transaction_info)
                 else:
                     logger.warning("Transaction details not found")
         else:
             logger.info("No messages found")
     except Exception as e:
-        logger.error(f"Error in main execution: {e}", exc_info=True)
+        logger.error("Error in main execution: %s", e, exc_info=True)
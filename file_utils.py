@@ -0,0 +1,22 @@
+import os
+import tempfile
+
+def atomic_write(path: str, data: bytes) -> None:
+    """
+    Writes data to a file atomically.
+    
+    The data goes to a temporary file in the same directory which then
+    replaces the target, so readers never see a partially written file.
+    
+    Args:
+        path: Destination file path
+        data: Content to write
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(dir=directory, prefix='.tmp-', delete=False) as tmp:
+        tmp.write(data)
+    try:
+        os.replace(tmp.name, path)
+    except OSError:
+        os.unlink(tmp.name)
+        raise
@@ -1,8 +1,15 @@
 import os
+import json
 import pickle
-from google_auth_oauthlib.flow import InstalledAppFlow
+import functools
+from datetime import datetime, timedelta, timezone
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
+from file_utils import atomic_write
 
 SCOPES = [
     'https://www.googleapis.com/auth/gmail.readonly',
@@ -10,25 +17,73 @@ SCOPES = [
     'https://www.googleapis.com/auth/gmail.labels'
 ]
 
+# Shared session so OAuth token refreshes reuse pooled keep-alive connections
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=20,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=1,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset(['GET', 'POST'])
+    )
+))
+AUTH_REQUEST = Request(session=SESSION)
+
+# The file token.json stores the user's access and refresh tokens, and is
+# created automatically when the authorization flow completes for the first time.
+TOKEN_FILE = 'token.json'
+# Token file written by earlier versions, migrated to TOKEN_FILE on first run
+LEGACY_TOKEN_FILE = 'token.pickle'
+
+# Refresh tokens this long before they expire
+REFRESH_MARGIN = timedelta(seconds=60)
+
+def refresh_if_expiring(creds):
+    # Only hit the token endpoint when the token is missing or about to expire
+    if creds.token and creds.expiry:
+        expiry = creds.expiry
+        if expiry.tzinfo is None:
+            # google-auth stores expiry as naive UTC
+            expiry = expiry.replace(tzinfo=timezone.utc)
+        if expiry - datetime.now(timezone.utc) > REFRESH_MARGIN:
+            return creds
+    creds.refresh(AUTH_REQUEST)
+    return creds
+
+@functools.lru_cache(maxsize=None)
+def service_account_info(path):
+    # Read and parse each service account key file only once per process
+    with open(path, 'r') as f:
+        return json.load(f)
+
+@functools.lru_cache(maxsize=1)
 def gmail_authenticate():
     creds = None
-    # The file token.pickle stores the user's access and refresh tokens, and is
-    # created automatically when the authorization flow completes for the first time.
-    if os.path.exists('token.pickle'):
-        with open('token.pickle', 'rb') as token:
+    if os.path.exists(TOKEN_FILE):
+        creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
+    elif os.path.exists(LEGACY_TOKEN_FILE):
+        # One-off migration of the old pickled token to JSON
+        with open(LEGACY_TOKEN_FILE, 'rb') as token:
             creds = pickle.load(token)
+        atomic_write(TOKEN_FILE, creds.to_json().encode('utf-8'))
+        os.remove(LEGACY_TOKEN_FILE)
 
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
+            creds.refresh(AUTH_REQUEST)
         else:
+            # Only needed for the interactive first-time authorization
+            from google_auth_oauthlib.flow import InstalledAppFlow
             flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
             creds = flow.run_local_server(port=0)
         # Save the credentials for the next run
-        with open('token.pickle', 'wb') as token:
-            pickle.dump(creds, token)
+        atomic_write(TOKEN_FILE, creds.to_json().encode('utf-8'))
     
-    return build('gmail', 'v1', credentials=creds)
+    # Use the discovery document bundled with the client library; no network
+    # fetch or discovery cache lookup at startup
+    return build('gmail', 'v1', credentials=creds, cache_discovery=False, static_discovery=True)
 
 # Call the Gmail API
 if __name__ == '__main__':
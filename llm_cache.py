@@ -0,0 +1,111 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+from datetime import timedelta
+from typing import Dict, Optional, Any
+import orjson
+from file_utils import atomic_write
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = timedelta(days=7)
+
+class LLMCache:
+    """
+    JSON-file backed cache of formatted transactions returned by the model.
+
+    Entries are keyed on the prompt version and the transaction info without
+    its date, so a recurring merchant and amount hit the cache and only the
+    date/time need to be filled in by the caller. Bumping the prompt version,
+    switching to another model or reaching the TTL invalidates an entry.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        prompt_version: str,
+        model_id: str,
+        ttl: timedelta = DEFAULT_TTL
+    ):
+        self.path = path
+        self.prompt_version = prompt_version
+        self.model_id = model_id
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._dirty = False
+
+        if os.path.exists(path):
+            try:
+                with open(path, 'rb') as f:
+                    entries = orjson.loads(f.read())
+                now = time.time()
+                self._entries = {
+                    key: entry for key, entry in entries.items()
+                    if self._is_current(entry, now)
+                }
+                self._dirty = len(self._entries) != len(entries)
+                logger.info("Loaded %s cached responses from %s", len(self._entries), path)
+            except (OSError, ValueError, AttributeError) as e:
+                logger.warning("Ignoring unreadable cache file %s: %s", path, e)
+
+    def _is_current(self, entry: Dict[str, Any], now: float) -> bool:
+        return (
+            isinstance(entry, dict)
+            and entry.get('promptVersion') == self.prompt_version
+            and entry.get('modelId') == self.model_id
+            and entry.get('expiresAt', 0) > now
+            and 'response' in entry
+        )
+
+    def make_key(self, transaction_info: Dict[str, Any]) -> str:
+        """
+        Builds a cache key from the transaction info, ignoring its date.
+
+        Args:
+            transaction_info: Dictionary containing transaction details
+
+        Returns:
+            Hex SHA-256 digest of the prompt version and normalized info
+        """
+        normalized = {k: v for k, v in transaction_info.items() if k != 'date'}
+        payload = orjson.dumps([self.prompt_version, normalized], option=orjson.OPT_SORT_KEYS)
+        return hashlib.sha256(payload).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if not self._is_current(entry, time.time()):
+                del self._entries[key]
+                self._dirty = True
+                return None
+            return dict(entry['response'])
+
+    def set(self, key: str, transaction_data: Dict[str, Any]) -> None:
+        now = time.time()
+        with self._lock:
+            self._entries[key] = {
+                'inputHash': key,
+                'promptVersion': self.prompt_version,
+                'modelId': self.model_id,
+                'response': dict(transaction_data),
+                'createdAt': now,
+                'expiresAt': now + self.ttl.total_seconds(),
+            }
+            self._dirty = True
+
+    def save(self) -> None:
+        """Writes the cache back to disk if it changed."""
+        with self._lock:
+            if not self._dirty:
+                return
+            try:
+                atomic_write(self.path, orjson.dumps(self._entries, option=orjson.OPT_INDENT_2))
+                self._dirty = False
+                logger.info("Saved %s cached responses to %s", len(self._entries), self.path)
+            except OSError as e:
+                logger.error("Error saving cache: %s", e)
@@ -1,36 +1,58 @@
 import json
 import os
+import functools
 from dotenv import load_dotenv
 from googleapiclient.discovery import build
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
 from google.oauth2 import service_account
+from gmail_auth import refresh_if_expiring, service_account_info
+from file_utils import atomic_write
 load_dotenv()
 
 # The ID and range of the spreadsheet.
 SERVICE_ACCOUNT_FILE = os.getenv('SERVICE_ACCOUNT_FILE')
 SPREADSHEET_ID = os.getenv('SPREADSHEET_ID')
 RANGE_NAME = 'Sheet1!A2:G' 
+# Rows sent per append request, so a failure part-way keeps earlier rows
+APPEND_CHUNK_SIZE = 50
 
-def sheets_service():
-    credentials = service_account.Credentials.from_service_account_file(
-        SERVICE_ACCOUNT_FILE,
+@functools.lru_cache(maxsize=1)
+def sheets_credentials():
+    return service_account.Credentials.from_service_account_info(
+        service_account_info(SERVICE_ACCOUNT_FILE),
         scopes=['https://www.googleapis.com/auth/spreadsheets'],
     )
-    credentials.refresh(Request())
-    service = build('sheets', 'v4', credentials=credentials)
-    return service.spreadsheets()
+
+@functools.lru_cache(maxsize=1)
+def _build_sheets_service():
+    return build(
+        'sheets', 'v4', credentials=sheets_credentials(),
+        cache_discovery=False, static_discovery=True
+    )
+
+def sheets_service():
+    refresh_if_expiring(sheets_credentials())
+    return _build_sheets_service().spreadsheets()
 
 def append_to_sheet(spreadsheet_id, range_name, values):
     service = sheets_service()
     body = {'values': values}
     result = service.values().append(
         spreadsheetId=spreadsheet_id, range=range_name,
-        valueInputOption='USER_ENTERED', body=body).execute()
+        valueInputOption='USER_ENTERED', insertDataOption='INSERT_ROWS',
+        body=body).execute()
     print('{0} cells appended.'.format(result.get('updates').get('updatedCells')))
 
+def append_in_chunks(spreadsheet_id, range_name, values, chunk_size=APPEND_CHUNK_SIZE, pending_file=None):
+    for start in range(0, len(values), chunk_size):
+        append_to_sheet(spreadsheet_id, range_name, values[start:start + chunk_size])
+        if pending_file:
+            # Drop uploaded rows from the file, so neither a rerun after a
+            # failure nor the next api.py run uploads them twice
+            atomic_write(pending_file, json.dumps(values[start + chunk_size:]).encode('utf-8'))
+
 if __name__ == '__main__':
     with open('transaction_data.json', 'r') as f:
         sheet_data = json.load(f)
-    append_to_sheet(SPREADSHEET_ID, RANGE_NAME, sheet_data)
+    append_in_chunks(SPREADSHEET_ID, RANGE_NAME, sheet_data, pending_file='transaction_data.json')
@@ -0,0 +1,163 @@
+import ast
+import asyncio
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+import orjson
+
+import api
+from llm_cache import LLMCache
+
+def response(text: str) -> SimpleNamespace:
+    return SimpleNamespace(
+        candidates=[SimpleNamespace(content=SimpleNamespace(parts=[SimpleNamespace(text=text)]))],
+        usage_metadata=None
+    )
+
+def formatted(transaction_info, **fields):
+    amount = api.INFO_RE.match(transaction_info['info']).group(1)
+    data = {
+        'amount': f"{float(amount):.2f}",
+        'currency': 'USD',
+        'merchant': 'Shop',
+        'category': 'Other',
+        'date': '01-02-2024',
+        'time': '01:05 PM',
+        'account': 'Wise',
+    }
+    data.update(fields)
+    return data
+
+class FakeModel:
+    """
+    Model that answers single prompts correctly and batch prompts with the
+    elements built by batch_elements from the transactions in the prompt.
+    """
+
+    def __init__(self, batch_elements):
+        self.batch_elements = batch_elements
+        self.prompts = []
+
+    async def generate_content_async(self, prompt, generation_config=None):
+        self.prompts.append(prompt)
+        if prompt.startswith('Transactions to format'):
+            infos = [
+                ast.literal_eval(line.split('. ', 1)[1])
+                for line in prompt.splitlines()[1:]
+            ]
+            return response(orjson.dumps(self.batch_elements(infos)).decode())
+        info = ast.literal_eval(prompt.split(': ', 1)[1])
+        return response(orjson.dumps(formatted(info)).decode())
+
+    @property
+    def single_prompts(self):
+        return [prompt for prompt in self.prompts if not prompt.startswith('Transactions')]
+
+def transaction_infos(count: int):
+    return [
+        {'date': '01-02-2024 13:05 PM', 'info': f'You spent {n} USD at Shop{n}.', 'account': 'Wise'}
+        for n in range(1, count + 1)
+    ]
+
+def amounts(results):
+    return [row[3] if row else None for row in results]
+
+class ProcessTransactionBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache = LLMCache(os.path.join(directory.name, 'cache.json'), 'test', 'model')
+
+    def run_batch(self, model, infos):
+        return asyncio.run(api.process_transaction_batch(model, infos, self.cache))
+
+    def test_elements_matched_by_index(self):
+        model = FakeModel(lambda infos: [
+            dict(formatted(info), index=n) for n, info in reversed(list(enumerate(infos, 1)))
+        ])
+        results = self.run_batch(model, transaction_infos(4))
+        self.assertEqual(amounts(results), ['1.00', '2.00', '3.00', '4.00'])
+        self.assertEqual(model.single_prompts, [])
+        self.assertTrue(all('index' not in entry['response'] for entry in self.cache._entries.values()))
+
+    def test_missing_index_retried_alone(self):
+        model = FakeModel(lambda infos: [
+            dict(formatted(info), index=n) for n, info in enumerate(infos, 1) if n != 2
+        ])
+        results = self.run_batch(model, transaction_infos(3))
+        self.assertEqual(amounts(results), ['1.00', '2.00', '3.00'])
+        self.assertEqual(len(model.single_prompts), 1)
+        self.assertIn('Shop2', model.single_prompts[0])
+
+    def test_duplicate_index_retried_alone(self):
+        def elements(infos):
+            # Transaction 3's output carries transaction 2's number
+            return [
+                dict(formatted(infos[0]), index=1),
+                dict(formatted(infos[1]), index=2),
+                dict(formatted(infos[2]), index=2),
+            ]
+        model = FakeModel(elements)
+        results = self.run_batch(model, transaction_infos(3))
+        self.assertEqual(amounts(results), ['1.00', '2.00', '3.00'])
+        self.assertEqual(len(model.single_prompts), 2)
+
+    def test_invalid_indexes_ignored(self):
+        def elements(infos):
+            return [
+                dict(formatted(infos[0]), index=1),
+                dict(formatted(infos[1]), index=0),
+                dict(formatted(infos[2]), index=5),
+                dict(formatted(infos[3]), index='4'),
+                dict(formatted(infos[1]), index=True),
+            ]
+        model = FakeModel(elements)
+        results = self.run_batch(model, transaction_infos(4))
+        self.assertEqual(amounts(results), ['1.00', '2.00', '3.00', '4.00'])
+        self.assertEqual(len(model.single_prompts), 3)
+
+    def test_non_array_response_processed_one_by_one(self):
+        model = FakeModel(lambda infos: formatted(infos[0]))
+        results = self.run_batch(model, transaction_infos(3))
+        self.assertEqual(amounts(results), ['1.00', '2.00', '3.00'])
+        self.assertEqual(len(model.single_prompts), 3)
+
+    def test_invalid_element_fails_alone(self):
+        def elements(infos):
+            return [
+                dict(formatted(infos[0]), index=1, merchant=None),
+                dict(formatted(infos[1]), index=2),
+            ]
+        model = FakeModel(elements)
+        results = self.run_batch(model, transaction_infos(2))
+        self.assertEqual(amounts(results), [None, '2.00'])
+
+    def test_mismatched_amount_not_cached(self):
+        def elements(infos):
+            return [
+                dict(formatted(infos[1]), index=1),
+                dict(formatted(infos[1]), index=2),
+            ]
+        model = FakeModel(elements)
+        infos = transaction_infos(2)
+        results = self.run_batch(model, infos)
+        self.assertEqual(amounts(results), [None, '2.00'])
+        self.assertIsNone(self.cache.get(self.cache.make_key(infos[0])))
+        self.assertIsNotNone(self.cache.get(self.cache.make_key(infos[1])))
+
+class FormatWithoutModelTest(unittest.TestCase):
+
+    def test_cache_hit_needs_email_date(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = LLMCache(os.path.join(directory, 'cache.json'), 'test', 'model')
+            info = transaction_infos(1)[0]
+            cache.set(cache.make_key(info), formatted(info, date='14-10-2025', time='09:05 PM'))
+            row = api.format_without_model(dict(info, date='03-04-2024 08:30 AM'), cache)
+            self.assertEqual(row[:2], ['03-04-2024', '08:30 AM'])
+            self.assertIsNone(api.format_without_model(dict(info, date=None), cache))
+
+if __name__ == '__main__':
+    unittest.main()
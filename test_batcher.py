@@ -0,0 +1,66 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from batcher import TransactionBatcher
+
+class FakeModel:
+    """
+    Batch processor whose latency is a fixed per-request overhead plus a
+    per-transaction cost, measured on a fake clock instead of real time.
+    """
+
+    def __init__(self, overhead: float, per_item: float, fail_calls=()):
+        self.overhead = overhead
+        self.per_item = per_item
+        self.fail_calls = set(fail_calls)
+        self.now = 0.0
+        self.sizes = []
+
+    def perf_counter(self) -> float:
+        return self.now
+
+    async def process_batch(self, items):
+        self.sizes.append(len(items))
+        self.now += self.overhead + self.per_item * len(items)
+        await asyncio.sleep(0)
+        if len(self.sizes) in self.fail_calls:
+            raise RuntimeError("transient failure")
+        return [item * 10 for item in items]
+
+def run_batcher(model: FakeModel, count: int, max_batch: int = 15, latency_slo: float = 20.0):
+    async def run():
+        batcher = TransactionBatcher(
+            model.process_batch, max_batch=max_batch, max_concurrent=1,
+            max_wait=0.01, latency_slo=latency_slo
+        )
+        async with batcher:
+            return await asyncio.gather(*(batcher.submit(i) for i in range(count)))
+
+    with mock.patch('batcher.time', perf_counter=model.perf_counter):
+        return asyncio.run(run())
+
+class TransactionBatcherTest(unittest.TestCase):
+
+    def test_results_in_submission_order(self):
+        model = FakeModel(overhead=2.0, per_item=0.5)
+        results = run_batcher(model, 40)
+        self.assertEqual(results, [i * 10 for i in range(40)])
+        self.assertEqual(model.sizes, [15, 15, 10])
+
+    def test_recovers_after_single_failure(self):
+        model = FakeModel(overhead=2.0, per_item=0.5, fail_calls={3})
+        results = run_batcher(model, 150)
+        self.assertEqual(sum(result is None for result in results), 15)
+        self.assertEqual(model.sizes[:6], [15, 15, 15, 7, 14, 15])
+        self.assertTrue(all(size == 15 for size in model.sizes[5:-1]))
+
+    def test_slow_batches_shrink_until_within_slo(self):
+        # 15 transactions take 17s; the SLO only allows 8 per request
+        model = FakeModel(overhead=2.0, per_item=1.0)
+        run_batcher(model, 60, latency_slo=10.0)
+        self.assertEqual(model.sizes[:2], [15, 7])
+        self.assertTrue(all(size <= 7 for size in model.sizes[1:]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import fetch_mails
+
+class FakeHttpError(Exception):
+    """Failed call inside a batch request, with the status of its response."""
+
+    def __init__(self, status: int):
+        super().__init__(f"HTTP {status}")
+        self.resp = SimpleNamespace(status=status)
+
+class FakeBatch:
+
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.msg_ids = []
+
+    def add(self, request, request_id):
+        self.msg_ids.append(request_id)
+
+    def execute(self):
+        self.service.batches.append(list(self.msg_ids))
+        if self.service.execute_failures:
+            self.service.execute_failures -= 1
+            raise ConnectionError("connection reset")
+        for msg_id in self.msg_ids:
+            self.service.calls[msg_id] = self.service.calls.get(msg_id, 0) + 1
+            statuses = self.service.errors.get(msg_id, [])
+            if statuses:
+                self.callback(msg_id, None, FakeHttpError(statuses.pop(0)))
+            else:
+                self.callback(msg_id, {'id': msg_id}, None)
+
+class FakeService:
+    """
+    Gmail service whose batch requests fail calls with the statuses queued
+    per message in errors, and fail whole execute() calls execute_failures
+    times.
+    """
+
+    def __init__(self, errors=None, execute_failures=0):
+        self.errors = errors or {}
+        self.execute_failures = execute_failures
+        self.batches = []
+        self.calls = {}
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(self, callback)
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def get(self, userId, id, format):
+        return id
+
+@mock.patch('fetch_mails.time.sleep')
+class FetchMessagesTest(unittest.TestCase):
+
+    def test_fetches_in_batches(self, sleep):
+        service = FakeService()
+        msg_ids = [f'm{i}' for i in range(120)]
+        messages = fetch_mails.fetch_messages(service, msg_ids)
+        self.assertEqual(set(messages), set(msg_ids))
+        self.assertEqual([len(batch) for batch in service.batches], [50, 50, 20])
+        sleep.assert_not_called()
+
+    def test_rejected_calls_are_retried(self, sleep):
+        service = FakeService(errors={'m1': [429], 'm3': [503, 500]})
+        messages = fetch_mails.fetch_messages(service, ['m0', 'm1', 'm2', 'm3'])
+        self.assertEqual(set(messages), {'m0', 'm1', 'm2', 'm3'})
+        self.assertEqual(service.batches, [['m0', 'm1', 'm2', 'm3'], ['m1', 'm3'], ['m3']])
+        self.assertEqual(sleep.call_count, 2)
+
+    def test_permanent_errors_are_not_retried(self, sleep):
+        service = FakeService(errors={'m1': [404]})
+        messages = fetch_mails.fetch_messages(service, ['m0', 'm1'])
+        self.assertEqual(set(messages), {'m0'})
+        self.assertEqual(service.calls['m1'], 1)
+        sleep.assert_not_called()
+
+    def test_gives_up_after_last_attempt(self, sleep):
+        service = FakeService(errors={'m1': [429] * fetch_mails.FETCH_ATTEMPTS})
+        messages = fetch_mails.fetch_messages(service, ['m0', 'm1'])
+        self.assertEqual(set(messages), {'m0'})
+        self.assertEqual(service.calls['m1'], fetch_mails.FETCH_ATTEMPTS)
+
+    def test_failed_execute_retries_unreturned_messages(self, sleep):
+        service = FakeService(execute_failures=1)
+        msg_ids = [f'm{i}' for i in range(60)]
+        messages = fetch_mails.fetch_messages(service, msg_ids)
+        self.assertEqual(set(messages), set(msg_ids))
+        # The first batch request fails, so everything is sent again
+        self.assertEqual([len(batch) for batch in service.batches], [50, 50, 10])
+        self.assertEqual(sleep.call_count, 1)
+
+    def test_failed_later_execute_keeps_earlier_batches(self, sleep):
+        service = FakeService()
+        msg_ids = [f'm{i}' for i in range(60)]
+        original_execute = FakeBatch.execute
+
+        def execute(batch):
+            if len(service.batches) == 1:
+                service.execute_failures = 1
+            original_execute(batch)
+
+        with mock.patch.object(FakeBatch, 'execute', execute):
+            messages = fetch_mails.fetch_messages(service, msg_ids)
+        self.assertEqual(set(messages), set(msg_ids))
+        self.assertEqual(service.batches[2], msg_ids[50:])
+        self.assertTrue(all(count == 1 for count in service.calls.values()))
+
+if __name__ == '__main__':
+    unittest.main()